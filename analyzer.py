@@ -5,6 +5,17 @@ analyzer.py — compute metrics for RFAM ROI tool.
 import cv2
 import numpy as np
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional; the NumPy Otsu is used instead
+    njit = None
+
+# Minimum Otsu separability (between-class / total variance) for an ROI's
+# own histogram to count as ink-vs-background.  Single-mode noise scores
+# about 0.64 (Gaussian) to 0.75 (uniform); ROIs with even a few percent
+# of ink score about 0.85 or more.
+OTSU_MIN_SEPARABILITY = 0.8
+
 def threshold_image(image):
     """
     Compute a binary mask using Otsu's threshold.
@@ -13,102 +24,262 @@ def threshold_image(image):
     ----------
     image : ndarray
         Input image, which may be grayscale or BGR.  If BGR, it will be
-        converted to grayscale internally.
+        converted to grayscale internally; callers that already hold the
+        grayscale image should use `threshold_image_gray` instead.
 
     Returns
     -------
-    mask : ndarray of bool
-        A boolean array where `True` indicates pixels above the Otsu
-        threshold (foreground) and `False` indicates background.
+    mask : ndarray of uint8
+        A 0/255 array where 255 indicates pixels above the Otsu
+        threshold (foreground) and 0 indicates background.
     """
     gray = image
     if len(image.shape) == 3:
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return threshold_image_gray(gray)
+
+
+def threshold_image_gray(gray):
+    """
+    Same as `threshold_image`, for an image that is already grayscale
+    (no colour conversion is attempted).
+    """
     _, thresh = cv2.threshold(
         gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU
     )
-    return thresh.astype(bool)
+    return thresh
+
+
+def _otsu_from_hist(hist):
+    """
+    Otsu threshold from a 256-bin histogram.
+
+    Returns the level `t` maximising the between-class variance, with
+    class 0 being values <= t (same convention as `cv2.THRESH_OTSU`).
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    levels = np.arange(hist.size, dtype=np.float64)
+    total = hist.sum()
+    w0 = np.cumsum(hist)
+    w1 = total - w0
+    m0 = np.cumsum(levels * hist)
+    m1 = m0[-1] - m0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma_b = w0 * w1 * (m0 / w0 - m1 / w1) ** 2
+    sigma_b[(w0 == 0) | (w1 == 0)] = 0.0
+    return int(np.argmax(sigma_b))
+
+
+def _otsu_from_hist_loop(hist):
+    """
+    Scalar-loop form of `_otsu_from_hist`, compiled with numba when it
+    is installed (and then used in its place).
+    """
+    total = 0.0
+    sum_all = 0.0
+    for t in range(hist.size):
+        total += hist[t]
+        sum_all += t * hist[t]
+    best = 0
+    best_var = 0.0
+    w0 = 0.0
+    m0 = 0.0
+    for t in range(hist.size):
+        w0 += hist[t]
+        m0 += t * hist[t]
+        w1 = total - w0
+        if w0 == 0 or w1 == 0:
+            continue
+        var = w0 * w1 * (m0 / w0 - (sum_all - m0) / w1) ** 2
+        if var > best_var:
+            best_var = var
+            best = t
+    return best
+
+
+if njit is not None:
+    _otsu_from_hist = njit(cache=True)(_otsu_from_hist_loop)
+
+
+def _otsu_separability(hist, t):
+    """
+    Otsu's separability measure at threshold `t`: the between-class
+    variance divided by the total variance (0..1, higher = more bimodal).
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    levels = np.arange(hist.size, dtype=np.float64)
+    n = hist.sum()
+    w0 = hist[:t + 1].sum()
+    w1 = n - w0
+    if w0 == 0 or w1 == 0:
+        return 0.0
+    s0 = (levels[:t + 1] * hist[:t + 1]).sum()
+    s_all = (levels * hist).sum()
+    var = (levels ** 2 * hist).sum() / n - (s_all / n) ** 2
+    if var <= 0:
+        return 0.0
+    between = w0 * w1 * (s0 / w0 - (s_all - s0) / w1) ** 2 / (n * n)
+    return float(between / var)
+
+
+def _median_from_hist(hist):
+    """
+    Median of the values described by a histogram with one bin per
+    integer level (bin `i` counts pixels of value `i`).
+
+    Matches `np.median` on the underlying pixels: for an even count the
+    two middle values are averaged.
+    """
+    cum = np.cumsum(hist)
+    n = int(cum[-1])
+    lo = int(np.searchsorted(cum, (n - 1) // 2, side='right'))
+    hi = int(np.searchsorted(cum, n // 2, side='right'))
+    return (lo + hi) / 2.0
 
 
 def compute_metrics(image, roi, px_per_mm=None,
-                    do_intensity=True, do_shape=False, do_halo=False):
+                    do_intensity=True, do_shape=False, do_halo=False,
+                    gray=None, global_thresh=None, keep_pixels=False):
     """
     Compute metrics for a given ROI.  Metrics are calculated on the
     segmented object(s) within the ROI rather than on the entire ROI
-    area.  A global Otsu threshold is applied to the ROI to separate
+    area.  An Otsu threshold computed on the ROI pixels separates
     dark objects (ink blots) from the brighter background.  Intensity
     statistics are then computed on the object pixels only.  Shape
     metrics and halo eccentricity are derived from the object mask.
 
+    The threshold is normally computed from the ROI's own pixels.  If
+    that histogram is not bimodal (Otsu separability below
+    `OTSU_MIN_SEPARABILITY`, e.g. a blank or background-only ROI), the
+    full-image Otsu mask is used for that ROI instead.
+
+    When analysing several ROIs on the same image, pass the precomputed
+    grayscale image (`gray`) and full-image Otsu mask (`global_thresh`,
+    as returned by `threshold_image_gray(gray)`) so they are not
+    recomputed for every ROI; the mask is otherwise computed on demand.
+
+    The raw object pixel values are only returned when `keep_pixels` is
+    set, since they can be large for big ROIs.
+
     Returns
     -------
     results : dict
         Dictionary of computed metrics.  Extra keys:
-          - 'mask_full': boolean mask of the object in full-resolution coords
+          - 'mask_bbox': (y0, x0, h, w) of the object in full-res coords
+          - 'mask_crop': boolean object mask within that bounding box
           - 'contours': list of OpenCV contours for the object
+          - 'intensity_hist': per-level histogram of the object pixels
+            (only with `do_intensity`)
           - 'intensity_pixels': 1D array of all object pixel values
+            (only with `do_intensity` and `keep_pixels`)
     """
-    # 1) Build binary ROI mask at full resolution
-    mask = np.zeros(image.shape[:2], dtype=np.uint8)
+    # 1) ROI bounding box from its geometry, padded by one pixel so the
+    #    object never touches the crop edge, and clipped to the image
     roi_type = roi.get('type')
     if roi_type == 'polygon':
         pts = np.array(roi['points'], dtype=np.int32)
-        cv2.fillPoly(mask, [pts], 255)
+        x, y, w, h = cv2.boundingRect(pts)
     elif roi_type == 'circle':
         center = tuple(map(int, roi['center']))
         radius = int(roi['radius'])
-        cv2.circle(mask, center, radius, 255, -1)
+        x, y = center[0] - radius, center[1] - radius
+        w = h = 2 * radius + 1
     else:
         # unsupported ROI types (e.g., ruler) → no metrics
         return {}
+    x0, y0 = max(0, x - 1), max(0, y - 1)
+    x1 = min(image.shape[1], x + w + 1)
+    y1 = min(image.shape[0], y + h + 1)
+    if x1 <= x0 or y1 <= y0:
+        return {}
 
-    # 2) Convert image to grayscale
-    gray = image
-    if len(image.shape) == 3:
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    # 2) Draw the binary ROI mask inside the bounding box only
+    mask_roi = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+    if roi_type == 'polygon':
+        cv2.fillPoly(mask_roi, [pts], 255, offset=(-x0, -y0))
+    else:
+        cv2.circle(mask_roi, (center[0] - x0, center[1] - y0), radius, 255, -1)
 
-    # 3) Apply ROI mask to grayscale
-    #    (not strictly needed for Otsu, but preserves blackout outside ROI)
-    roi_gray = cv2.bitwise_and(gray, gray, mask=mask)
+    # 3) Grayscale crop (sliced from `gray` when supplied by the caller)
+    if gray is not None:
+        gray_roi = gray[y0:y1, x0:x1]
+    else:
+        gray_roi = image[y0:y1, x0:x1]
+        if len(image.shape) == 3:
+            gray_roi = cv2.cvtColor(gray_roi, cv2.COLOR_BGR2GRAY)
 
     # 4) If ROI is empty, bail
-    if not np.any(mask):
+    if cv2.countNonZero(mask_roi) == 0:
         return {}
 
     results = {}
 
-    # 5) Global Otsu threshold (bright vs. dark)
-    global_thresh = threshold_image(image)  # True = bright region
-    # Invert within ROI to get dark-ink object pixels
-    object_mask = np.zeros_like(mask, dtype=np.uint8)
-    object_mask[(~global_thresh) & (mask.astype(bool))] = 255
+    # 5) Otsu threshold (bright vs. dark) on the ROI pixels only.  Dark-ink
+    #    object pixels are those at or below the threshold.  When the ROI
+    #    histogram is not bimodal enough (e.g. a blank/background-only ROI)
+    #    the full-image Otsu mask decides instead, so noise is not split
+    #    into a fake object.
+    roi_hist = np.bincount(gray_roi[mask_roi.astype(bool)], minlength=256)
+    T = int(_otsu_from_hist(roi_hist))
+    if _otsu_separability(roi_hist, T) >= OTSU_MIN_SEPARABILITY:
+        dark = cv2.compare(gray_roi, T, cv2.CMP_LE)
+    else:
+        if global_thresh is None:
+            full_gray = gray if gray is not None else image
+            if len(full_gray.shape) == 3:
+                full_gray = cv2.cvtColor(full_gray, cv2.COLOR_BGR2GRAY)
+            global_thresh = threshold_image_gray(full_gray)
+        # global mask: non-zero = bright
+        dark = cv2.compare(global_thresh[y0:y1, x0:x1], 0, cv2.CMP_EQ)
+    # uint8 (0/255) object mask for the OpenCV calls, whatever the input
+    # depth (cv2.compare always yields 8-bit); the boolean form is built
+    # once and reused below
+    object_mask = cv2.bitwise_and(dark, mask_roi)
+    object_bool = object_mask.astype(bool)
 
-    # 6) Extract contours of the object(s)
+    # 6) Extract contours of the object(s), in full-resolution coords
     contours, _ = cv2.findContours(
         object_mask,
         cv2.RETR_EXTERNAL,
-        cv2.CHAIN_APPROX_SIMPLE
+        cv2.CHAIN_APPROX_SIMPLE,
+        offset=(x0, y0)
     )
     results['contours'] = contours
-    # Expose full-resolution boolean mask for downstream cropping
-    results['mask_full'] = object_mask.astype(bool)
+    # Expose the object mask as its tight bbox + crop (instead of a
+    # full-resolution boolean) for downstream cropping
+    ox, oy, ow, oh = cv2.boundingRect(object_mask)
+    results['mask_bbox'] = (y0 + oy, x0 + ox, oh, ow)
+    results['mask_crop'] = object_bool[oy:oy+oh, ox:ox+ow].copy()
 
     # 7) Intensity metrics on object pixels
     if do_intensity:
-        obj_pixels = gray[object_mask.astype(bool)]
-        if obj_pixels.size > 0:
-            results['mean_I']   = float(np.mean(obj_pixels))
-            results['median_I'] = float(np.median(obj_pixels))
-            results['std_I']    = float(np.std(obj_pixels))
+        # single masked pass for mean/std; the median and area come from
+        # a masked histogram with one bin per level (256 for 8-bit,
+        # 65536 for 16-bit scans), so object pixels are never gathered
+        mean, std = cv2.meanStdDev(gray_roi, mask=object_mask)
+        nbins = 65536 if gray_roi.dtype == np.uint16 else 256
+        hist = cv2.calcHist(
+            [gray_roi], [0], object_mask, [nbins], [0, nbins]
+        ).ravel().astype(np.int64)
+        area = int(hist.sum())
+        if area > 0:
+            results['mean_I']   = float(mean[0, 0])
+            results['median_I'] = _median_from_hist(hist)
+            results['std_I']    = float(std[0, 0])
         else:
             results['mean_I'] = results['median_I'] = results['std_I'] = None
-        results['area_px'] = int(np.sum(object_mask > 0))
-        # raw array for plotting histograms / heatmaps
-        results['intensity_pixels'] = obj_pixels
+        results['area_px'] = area
+        # per-level counts for plotting (see plots.plot_level_histogram)
+        results['intensity_hist'] = hist
+        if keep_pixels:
+            # raw array for plotting histograms / heatmaps
+            results['intensity_pixels'] = gray_roi[object_bool]
+
+    # Largest contour, shared by the shape and halo metrics
+    cnt = max(contours, key=cv2.contourArea) if contours else None
 
     # 8) Shape metrics (largest contour)
-    if do_shape and contours:
-        cnt = max(contours, key=cv2.contourArea)
+    if do_shape and cnt is not None:
         area = cv2.contourArea(cnt)
         perim = cv2.arcLength(cnt, True)
         results['perimeter_px'] = float(perim)
@@ -133,11 +304,22 @@ def compute_metrics(image, roi, px_per_mm=None,
             float(area / hull_area) if hull_area > 0 else None
         )
 
-    # 9) Halo eccentricity
-    if do_halo and contours:
-        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5,5))
-        core = cv2.erode(object_mask, kernel, iterations=1)
-        halo = cv2.subtract(object_mask, core)
+    # 9) Halo eccentricity (erosion limited to the largest contour's
+    #    bbox, padded by the kernel radius; contour coords are full-res).
+    #    A k×k rectangular erosion is done as two separable 1-D passes.
+    if do_halo and cnt is not None:
+        k = 5
+        r = k // 2
+        cx0, cy0, cw, ch = cv2.boundingRect(cnt)
+        cx0, cy0 = cx0 - x0, cy0 - y0
+        sub = object_mask[
+            max(0, cy0 - r):min(object_mask.shape[0], cy0 + ch + r),
+            max(0, cx0 - r):min(object_mask.shape[1], cx0 + cw + r)
+        ]
+        row = cv2.getStructuringElement(cv2.MORPH_RECT, (k, 1))
+        col = cv2.getStructuringElement(cv2.MORPH_RECT, (1, k))
+        core = cv2.erode(cv2.erode(sub, row), col)
+        halo = cv2.subtract(sub, core)
         halo_cnts, _ = cv2.findContours(
             halo,
             cv2.RETR_EXTERNAL,
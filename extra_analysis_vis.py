@@ -2,22 +2,33 @@
 """
 visualize_intensity_multi_matplotlib.py
 
-Loads one or more RFAM‐tool session CSVs and combines their analyses.
+Loads one or more RFAM‐tool session CSVs and combines their analyses
+(streamed file by file into per-ink arrays of mean intensities).
 Then produces Matplotlib plots:
   1) Boxplot of replicate mean intensities by ink type
   2) Bar chart of average mean intensity per ink type
   3) Scatter of individual replicate intensities (with jitter)
 
-Dependencies: tkinter, pandas, numpy, matplotlib
+Dependencies: tkinter, pandas, numpy, matplotlib (pyarrow optional, for
+faster CSV loading)
 """
-import os
 import tkinter as tk
+from collections import defaultdict
 from tkinter import filedialog
 
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:  # fall back to pandas' CSV reader
+    pa = pacsv = None
+
+# Only these columns are needed for the plots below
+PLOT_COLUMNS = ["ink_key", "mean_I"]
+
 def select_csvs():
     root = tk.Tk()
     root.withdraw()
@@ -28,14 +39,31 @@ def select_csvs():
     root.destroy()
     return list(paths)
 
-def load_and_tag(paths):
-    """Read each CSV and add a __source column."""
-    frames = []
+def read_plot_columns(path):
+    """Read only the plotted columns of one CSV into a DataFrame."""
+    if pacsv is not None:
+        # pin mean_I: an all-blank column would otherwise be typed null
+        co = pacsv.ConvertOptions(
+            include_columns=PLOT_COLUMNS,
+            column_types={"mean_I": pa.float64()}
+        )
+        ro = pacsv.ReadOptions(use_threads=True)
+        # older session CSVs carry quoted multi-line array reprs
+        po = pacsv.ParseOptions(newlines_in_values=True)
+        table = pacsv.read_csv(
+            path, read_options=ro, parse_options=po, convert_options=co
+        )
+        return table.to_pandas()
+    return pd.read_csv(path, usecols=PLOT_COLUMNS)
+
+def load_by_ink(paths):
+    """Stream each CSV and collect mean_I values per ink_key."""
+    buckets = defaultdict(list)
     for p in paths:
-        df = pd.read_csv(p)
-        df["__source"] = os.path.basename(p)
-        frames.append(df)
-    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        df = read_plot_columns(p)
+        for k, v in df.groupby("ink_key")["mean_I"]:
+            buckets[int(k)].append(v.to_numpy(dtype=float))
+    return {k: np.concatenate(vs) for k, vs in buckets.items()}
 
 def main():
     # 1) Pick files
@@ -44,9 +72,9 @@ def main():
         print("No files selected. Exiting.")
         return
 
-    # 2) Load & tag
-    df = load_and_tag(paths)
-    if df.empty:
+    # 2) Load, grouped by ink key
+    by_key = load_by_ink(paths)
+    if not by_key:
         print("No data loaded. Exiting.")
         return
 
@@ -57,8 +85,7 @@ def main():
         3: "25 wt% C, IPA",
         4: "Sharpie (control)"
     }
-    df["ink_key"] = df["ink_key"].astype(int)
-    df["ink_desc"] = df["ink_key"].map(desc_map)
+    by_ink = {desc_map[k]: v for k, v in by_key.items() if k in desc_map}
 
     # 4) Matplotlib style
     plt.style.use("ggplot")
@@ -67,7 +94,7 @@ def main():
     order = list(desc_map.values())
 
     # 5) Boxplot
-    data = [ df[df["ink_desc"]==ink]["mean_I"].values for ink in order ]
+    data = [ by_ink.get(ink, np.array([])) for ink in order ]
     fig, ax = plt.subplots(figsize=(8,5))
     bp = ax.boxplot(
         data,
@@ -83,12 +110,19 @@ def main():
     plt.show()
 
     # 6) Bar chart of averages ± std
-    means = df.groupby("ink_desc")["mean_I"].mean().reindex(order)
-    stds  = df.groupby("ink_desc")["mean_I"].std().reindex(order).fillna(0)
+    #    (NaNs skipped and single-sample std shown as 0, as in pandas)
+    means = np.full(len(order), np.nan)
+    stds  = np.zeros(len(order))
+    for i, vals in enumerate(data):
+        vals = vals[~np.isnan(vals)]
+        if vals.size:
+            means[i] = vals.mean()
+        if vals.size > 1:
+            stds[i] = vals.std(ddof=1)
 
     x = np.arange(len(order))
     fig, ax = plt.subplots(figsize=(6,4))
-    ax.bar(x, means.values, yerr=stds.values, capsize=5, color="lightblue", edgecolor="gray")
+    ax.bar(x, means, yerr=stds, capsize=5, color="lightblue", edgecolor="gray")
     ax.set_xticks(x)
     ax.set_xticklabels(order, rotation=45, ha="right")
     ax.set_title("Average Mean Intensity per Ink Type")
@@ -97,12 +131,14 @@ def main():
     plt.show()
 
     # 7) Scatter with jitter
+    #    (all inks in one draw call, coloured by the style's colour cycle)
     fig, ax = plt.subplots(figsize=(8,5))
-    for i, ink in enumerate(order):
-        vals = df[df["ink_desc"]==ink]["mean_I"].values
-        # add horizontal jitter
-        xs = np.random.normal(i, 0.05, size=len(vals))
-        ax.scatter(xs, vals, alpha=0.8, edgecolors="w", s=60)
+    pos = np.repeat(x, [len(v) for v in data])
+    # add horizontal jitter
+    xs = np.random.default_rng().normal(pos, 0.05)
+    cycle = np.array(plt.rcParams["axes.prop_cycle"].by_key()["color"])
+    ax.scatter(xs, np.concatenate(data), c=cycle[pos % len(cycle)],
+               alpha=0.8, edgecolors="w", s=60)
     ax.set_xticks(x)
     ax.set_xticklabels(order, rotation=45, ha="right")
     ax.set_title("Individual Replicate Mean Intensities")
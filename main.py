@@ -9,10 +9,10 @@ import matplotlib.pyplot as plt
 from matplotlib import colors
 
 from gui import main as gui_main
-from analyzer import compute_metrics
+from analyzer import compute_metrics, threshold_image_gray
 from dataio import build_dataframe, export_csv
 from plots import (
-    plot_histogram,
+    plot_level_histogram,
     plot_boxplot,
     plot_area_histogram,
     plot_area_vs_intensity,
@@ -36,6 +36,12 @@ def main():
         return
 
     # 3) Compute metrics per ROI
+    #    (grayscale conversion and the full-image Otsu mask, used for
+    #    ROIs without a bimodal histogram, are shared by every ROI; each
+    #    intensity histogram is plotted from the analyzer's per-level
+    #    counts as soon as its ROI is done, so no pixel arrays are kept)
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    global_thresh = threshold_image_gray(gray)
     results = []
     for roi in session['rois']:
         metrics = compute_metrics(
@@ -44,38 +50,42 @@ def main():
             px_per_mm=session['px_per_mm'],
             do_intensity=session['analysis']['intensity'],
             do_shape=session['analysis']['shape'],
-            do_halo=session['analysis']['halo']
+            do_halo=session['analysis']['halo'],
+            gray=gray,
+            global_thresh=global_thresh
         )
-        # carry forward mask_full for ROI‐only heatmaps
+        hist = metrics.pop('intensity_hist', None)
+        if hist is not None:
+            try:
+                plot_level_histogram(hist, roi['label'])
+            except Exception as e:
+                print(f"Warning: histogram {roi['label']} failed: {e}")
         metrics.update({
             'label':     roi['label'],
             'ink_key':   roi['ink_key'],
-            'rep':       roi['rep'],
-            'mask_full': metrics.get('mask_full')
+            'rep':       roi['rep']
         })
         results.append(metrics)
 
     # 4) ROI‐only heatmaps (Viridis, each scaled to its own min/max)
     scale = session['scale']
     for r in results:
-        mask = r.get('mask_full')
-        if mask is None:
+        bbox = r.get('mask_bbox')
+        if bbox is None or bbox[2] == 0:
             continue
         label = r['label']
 
-        # Bounding box with padding
-        ys, xs = np.nonzero(mask)
-        y0, y1 = ys.min(), ys.max()
-        x0, x1 = xs.min(), xs.max()
-        pad = 1000
+        # Object bounding box (full-res) with padding
+        y0, x0, h_o, w_o = bbox
+        y1, x1 = y0 + h_o - 1, x0 + w_o - 1
+        # ~50 px margin in the downsampled heatmap
+        pad = max(20, int(50 / max(scale, 1e-3)))
         y0p = max(0, y0 - pad)
         y1p = min(img.shape[0] - 1, y1 + pad)
         x0p = max(0, x0 - pad)
         x1p = min(img.shape[1] - 1, x1 + pad)
-        crop = img[y0p:y1p+1, x0p:x1p+1]
-
-        # Convert to grayscale
-        gray_crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY) if crop.ndim == 3 else crop.copy()
+        # Crop the shared grayscale image (no per-ROI conversion)
+        gray_crop = gray[y0p:y1p+1, x0p:x1p+1]
 
         # Downsample the crop
         h_c, w_c = gray_crop.shape[:2]
@@ -127,15 +137,7 @@ def main():
         ax.axis('off')
         plt.show()
 
-    # 5) Full-image intensity histograms & boxplot
-    intensity_arrays = [
-        r['intensity_pixels'] for r in results
-        if r.get('intensity_pixels') is not None
-    ]
-    labels      = [
-        r['label'] for r in results
-        if r.get('intensity_pixels') is not None
-    ]
+    # 5) Mean-intensity boxplot
     mean_vals   = [
         r['mean_I'] for r in results
         if r.get('mean_I') is not None
@@ -145,12 +147,6 @@ def main():
         if r.get('mean_I') is not None
     ]
 
-    for arr, lbl in zip(intensity_arrays, labels):
-        try:
-            plot_histogram(arr, lbl)
-        except Exception as e:
-            print(f"Warning: histogram {lbl} failed: {e}")
-
     if mean_vals:
         try:
             plot_boxplot(mean_vals, mean_labels)
@@ -189,7 +185,13 @@ def main():
         'analysis_halo':      session['analysis']['halo'],
         'conversion_used':    session['conversion_used'],
     }
-    df = build_dataframe(results, metadata)
+    # array-valued entries (contours, object mask) stay out of the CSV
+    array_keys = ('contours', 'mask_crop')
+    rows = [
+        {k: v for k, v in r.items() if k not in array_keys}
+        for r in results
+    ]
+    df = build_dataframe(rows, metadata)
     outdir = os.path.join(os.path.dirname(__file__), 'session_data')
     os.makedirs(outdir, exist_ok=True)
     csv_path = export_csv(df, outdir)
@@ -212,10 +214,12 @@ def main():
         else:
             vis_color = vis.copy()
 
-        for r in results:
-            for cnt in r.get('contours', []):
-                cnt_disp = (cnt * scale).astype(int)
-                cv2.drawContours(vis_color, [cnt_disp], -1, (0, 255, 0), 2)
+        # scale every contour to display coords, then draw them in one call
+        all_cnts = [
+            np.round(cnt.astype(np.float32) * scale).astype(np.int32)
+            for r in results for cnt in r.get('contours', [])
+        ]
+        cv2.drawContours(vis_color, all_cnts, -1, (0, 255, 0), 2)
 
         cv2.imshow('Object Outlines', vis_color)
         print("Press 'q' or ESC to close outlines.")
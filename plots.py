@@ -2,12 +2,44 @@
 """
 plots.py — Matplotlib plotting for RFAM ROI tool.
 """
+import numpy as np
 import matplotlib.pyplot as plt
 
 def plot_histogram(intensities, label):
-    """Show histogram of pixel intensities."""
+    """Show a 256-bin histogram of pixel intensities."""
+    values = np.asarray(intensities).ravel()
+    if values.dtype == np.uint8:
+        # one bincount pass instead of letting matplotlib bin every pixel
+        hist = np.bincount(values, minlength=256)
+        edges = np.arange(257)
+    else:
+        # deeper (e.g. 16-bit) data: rebin to 256 bins over its range
+        hist, edges = np.histogram(values, bins=256)
+    _show_histogram(hist, edges, label)
+
+def plot_level_histogram(counts, label):
+    """
+    Show a histogram from per-level pixel counts (bin i = value i), such
+    as the 'intensity_hist' returned by compute_metrics.
+    """
+    counts = np.asarray(counts)
+    if counts.size <= 256:
+        hist = counts
+        edges = np.arange(counts.size + 1)
+    else:
+        # deeper (e.g. 16-bit) counts: rebin to 256 bins over the occupied
+        # range, same as np.histogram(bins=256) on the raw pixels
+        occupied = np.flatnonzero(counts)
+        lo, hi = (occupied[0], occupied[-1]) if occupied.size else (0, 0)
+        hist, edges = np.histogram(
+            np.arange(lo, hi + 1), bins=256, weights=counts[lo:hi + 1]
+        )
+    _show_histogram(hist, edges, label)
+
+def _show_histogram(hist, edges, label):
     plt.figure()
-    plt.hist(intensities, bins=256, color='gray', edgecolor='black')
+    plt.bar(edges[:-1], hist, width=np.diff(edges), align='edge',
+            color='gray', edgecolor='none')
     plt.title(f'Intensity Histogram: {label}')
     plt.xlabel('Pixel Intensity')
     plt.ylabel('Frequency')